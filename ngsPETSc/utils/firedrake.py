@@ -9,6 +9,7 @@ except ImportError:
     ufl = None
 
 import warnings
+import functools
 import numpy as np
 from petsc4py import PETSc
 
@@ -25,6 +26,38 @@ except ImportError:
 
 from ngsPETSc import MeshMapping
 
+def _requireFiredrake(func):
+    '''
+    This decorator replaces the wrapped function by one raising an ImportError
+    when Firedrake is not installed, otherwise the function is returned untouched.
+
+    :arg func: the function requiring Firedrake
+
+    '''
+    if fd is not None:
+        return func
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        raise ImportError("Firedrake is not installed, "+func.__name__+" is not available.")
+    return wrapper
+
+def _cellOffsets(mesh, nE):
+    '''
+    This function returns the Firedrake cell numbers of the Netgen elements,
+    the result is cached on the mesh since the cell numbering does not change.
+
+    :arg mesh: the Firedrake mesh
+    :arg nE: the number of Netgen elements
+
+    '''
+    offsets = getattr(mesh, "_cachedCellOffsets", None)
+    if offsets is None or offsets.shape[0] != nE:
+        getIdx = mesh._cell_numbering.getOffset
+        offsets = np.fromiter(map(getIdx, range(nE)), dtype=np.int32, count=nE)
+        mesh._cachedCellOffsets = offsets
+    return offsets
+
+@_requireFiredrake
 def refineMarkedElements(self, mark):
     '''
     This method is used to refine a mesh based on a marking function
@@ -36,91 +69,238 @@ def refineMarkedElements(self, mark):
     if self.geometric_dimension() == 2:
         with mark.dat.vec as marked:
             marked0 = marked
-            getIdx = self._cell_numbering.getOffset
             if self.sfBCInv is not None:
-                getIdx = lambda x: x
                 _, marked0 = self.topology_dm.distributeField(self.sfBCInv,
                                                               self._cell_numbering,
                                                               marked)
             if self.comm.Get_rank() == 0:
                 mark = marked0.getArray()
-                for i, el in enumerate(self.netgen_mesh.Elements2D()):
-                    if mark[getIdx(i)]:
-                        el.refine = True
-                    else:
-                        el.refine = False
+                els = self.netgen_mesh.Elements2D()
+                nE = len(els)
+                #Computing all the refinement flags at once, so that the loop
+                #only sets the Netgen attribute
+                if self.sfBCInv is not None:
+                    refine = mark[:nE] != 0
+                else:
+                    refine = mark[_cellOffsets(self, nE)] != 0
+                for el, flag in zip(els, refine.tolist()):
+                    el.refine = flag
                 self.netgen_mesh.Refine(adaptive=True)
                 return fd.Mesh(self.netgen_mesh)
             return fd.Mesh(netgen.libngpy._meshing.Mesh(2))
     else:
         raise NotImplementedError("No implementation for dimension other than 2.")
 
-def curveField(self, order):
+def _pointKeys(pts, keyPrecision, dtype):
+    '''
+    This function rounds the points to the given precision and returns their
+    integer coordinates.
+
+    :arg pts: the points, of shape (..., d)
+    :arg keyPrecision: the precision to which the points are rounded
+    :arg dtype: the integer type of the coordinates
+
+    '''
+    scaled = np.multiply(pts, 1/keyPrecision)
+    np.rint(scaled, out=scaled)
+    return scaled.astype(dtype)
+
+def _pointHashes(keys):
+    '''
+    This function packs the integer coordinates of each point in a single int64 hash,
+    the multiplication is allowed to wrap around and collisions are left to the caller.
+
+    :arg keys: the integer coordinates of the points, of shape (..., d)
+
+    '''
+    hashes = keys[..., 0].astype(np.int64)
+    for k in range(1, keys.shape[-1]):
+        hashes *= 1000003
+        hashes += keys[..., k]
+    return hashes
+
+def _cellPermutation(physPts, dofPts, keyPrecision=1e-8):
+    '''
+    This function computes for every cell the permutation that maps the points
+    computed by Netgen to the points associated with the Firedrake dofs.
+
+    :arg physPts: the points computed by Netgen, of shape (nE, nR, d)
+    :arg dofPts: the points associated with the Firedrake dofs, of shape (nE, nR, d)
+    :arg keyPrecision: the precision to which the points are rounded before matching
+
+    '''
+    nE, nR, d = physPts.shape
+    #Half-width keys are enough when all rounded coordinates fit in an int32
+    bound = max(np.abs(physPts).max(initial=0), np.abs(dofPts).max(initial=0))
+    if bound/keyPrecision < np.iinfo(np.int32).max:
+        dtype = np.int32
+    else:
+        dtype = np.int64
+    physKeys = _pointKeys(physPts, keyPrecision, dtype)
+    dofKeys = _pointKeys(dofPts, keyPrecision, dtype)
+    rows = np.arange(nE)[:, None]
+    def match(physHashes, dofHashes):
+        #Points with the same hash end up in the same position once sorted
+        p = np.empty((nE, nR), dtype=np.intp)
+        p[rows, np.argsort(dofHashes, axis=1)] = np.argsort(physHashes, axis=1)
+        return p
+    p = match(_pointHashes(physKeys), _pointHashes(dofKeys))
+    if not np.array_equal(physKeys[rows, p], dofKeys):
+        #Either two hashes collided or the points do not match, hence we sort the
+        #full integer coordinates viewed as opaque blobs
+        blob = np.dtype((np.void, physKeys.itemsize*d))
+        p = match(physKeys.view(blob)[..., 0], dofKeys.view(blob)[..., 0])
+        if not np.array_equal(physKeys[rows, p], dofKeys):
+            raise ValueError("Netgen points do not match the Firedrake dofs.")
+    return p
+
+_permCache = {}
+
+def _cachedCellPermutation(physPts, dofPts, d, order, keyPrecision=1e-8):
+    '''
+    This function computes for every cell the permutation that maps the points
+    computed by Netgen to the points associated with the Firedrake dofs.
+    The permutation only depends on how the vertices of the Netgen element are ordered
+    with respect to the ones of the Firedrake cell, hence only the vertices are matched
+    and the permutation of all the points is cached for each ordering of the vertices.
+
+    :arg physPts: the points computed by Netgen, of shape (nE, nR, d), vertices first
+    :arg dofPts: the points associated with the Firedrake dofs, of shape (nE, nR, d),
+    vertices first, otherwise all the points are matched
+    :arg d: the dimension of the cells
+    :arg order: the order of the reference points
+    :arg keyPrecision: the precision to which the points are rounded before matching
+
+    '''
+    nR = physPts.shape[1]
+    try:
+        vertexPerm = _cellPermutation(physPts[:, :d+1], dofPts[:, :d+1], keyPrecision)
+    except ValueError:
+        #The first dofs of some cell are not its vertices, matching all the points
+        return _cellPermutation(physPts, dofPts, keyPrecision)
+    codes = vertexPerm @ (d+1)**np.arange(d+1)
+    uniqueCodes, first, inverse = np.unique(codes, return_index=True, return_inverse=True)
+    table = np.empty((len(uniqueCodes), nR), dtype=np.intp)
+    for k, (code, i) in enumerate(zip(uniqueCodes.tolist(), first)):
+        #A single cell with this vertex ordering is enough to compute the permutation
+        if (d, order, code) not in _permCache:
+            _permCache[(d, order, code)] = _cellPermutation(physPts[i:i+1], dofPts[i:i+1],
+                                                            keyPrecision)[0]
+        table[k] = _permCache[(d, order, code)]
+    p = table[inverse.ravel()]
+    if not np.allclose(np.take_along_axis(physPts, p[:, :, None], axis=1), dofPts,
+                       rtol=0, atol=keyPrecision):
+        #The points of some cell are not laid out as expected, matching them all
+        p = _cellPermutation(physPts, dofPts, keyPrecision)
+    return p
+
+_refPointsCache = {}
+
+def _referencePoints(refElement, d, order):
+    '''
+    This function returns the reference points mapped by Netgen, i.e. the Lagrange
+    points of the given order on every sub-entity of the reference cell but its interior.
+    They only depend on the dimension and the order, hence they are cached.
+
+    :arg refElement: the FIAT reference simplex
+    :arg d: the dimension of the reference simplex
+    :arg order: the order of the Lagrange points
+
+    '''
+    if (d, order) not in _refPointsCache:
+        refPts = [np.asarray(refElement.make_points(i,j,order)).reshape(-1, d)
+                  for (i,j) in refElement.sub_entities[d][0] if i < d]
+        refPts = np.concatenate(refPts, axis=0) if refPts else np.empty((0, d))
+        _refPointsCache[(d, order)] = refPts
+    return _refPointsCache[(d, order)]
+
+def _fillStraightCoordinates(mesh, newCoordinates):
+    '''
+    This function writes into a DG vector function the coordinates of the
+    straight sided mesh, mapping the DG nodes affinely from the vertices of each cell.
+    This is equivalent to interpolating piecewise linear mesh coordinates,
+    without generating and running an interpolation kernel.
+
+    :arg mesh: the Firedrake simplex mesh, with piecewise linear coordinates
+    :arg newCoordinates: the DG vector function to be filled
+
+    '''
+    fiatElement = newCoordinates.function_space().finat_element.fiat_equivalent
+    #Reference coordinates of the DG nodes, in the order of the dofs
+    nodes = np.array([next(iter(node.get_point_dict())) for node in fiatElement.dual_basis()])
+    #Barycentric coordinates of the nodes with respect to the reference vertices
+    verts = np.asarray(fiatElement.ref_el.get_vertices())
+    bary = np.linalg.solve(np.vstack([verts.T, np.ones(len(verts))]),
+                           np.vstack([nodes.T, np.ones(len(nodes))]))
+    coordinates = mesh.coordinates
+    vertexCoords = coordinates.dat.data_ro_with_halos[coordinates.cell_node_map().values]
+    straightPts = np.einsum("vn,cvk->cnk", bary, vertexCoords)
+    #Every owned dof is overwritten, hence the data is accessed write-only
+    newCoordinates.dat.data_wo[newCoordinates.cell_node_map().values] = straightPts
+
+@_requireFiredrake
+def curveField(self, order, keyPrecision=1e-8):
     '''
     This method returns a curved mesh as a Firedrake funciton.
 
     :arg order: the order of the curved mesh
+    :arg keyPrecision: the precision used to match Netgen and Firedrake points,
+    the curved coordinates themselves are not rounded
 
     '''
-    newFunctionCoordinates = fd.interpolate(self.coordinates,
-                                            fd.VectorFunctionSpace(self,"DG",order))
-    V = newFunctionCoordinates.dat.data
-    #Computing reference points using ufl
+    d = self.geometric_dimension()
+    #The DG space is cached on the mesh for each order,
+    #so that repeated calls skip its construction
+    cache = getattr(self, "_curveFieldCache", None)
+    if cache is None:
+        cache = self._curveFieldCache = {}
+    if order not in cache:
+        cache[order] = fd.VectorFunctionSpace(self,"DG",order)
+    newFunctionCoordinates = fd.Function(cache[order])
+    #The affine fill only applies to piecewise linear coordinates on simplices
+    linear = self.coordinates.function_space().ufl_element().degree() == 1
+    if linear and self.ufl_cell().is_simplex():
+        _fillStraightCoordinates(self, newFunctionCoordinates)
+    else:
+        newFunctionCoordinates.interpolate(self.coordinates)
+    #Computing reference points using fiat
     ref_element = newFunctionCoordinates.function_space().finat_element.fiat_equivalent.ref_el
-    getIdx = self._cell_numbering.getOffset
-    refPts = []
-    for (i,j) in ref_element.sub_entities[self.geometric_dimension()][0]:
-        if i < self.geometric_dimension():
-            refPts = refPts+list(ref_element.make_points(i,j,order))
-    refPts = np.array(refPts)
-    if self.geometric_dimension() == 2:
-        #Mapping to the physical domain
-        physPts = np.ndarray((len(self.netgen_mesh.Elements2D()),
-                             refPts.shape[0], self.geometric_dimension()))
-        self.netgen_mesh.CalcElementMapping(refPts, physPts)
-        #Cruving the mesh
-        self.netgen_mesh.Curve(order)
-        curvedPhysPts = np.ndarray((len(self.netgen_mesh.Elements2D()),
-                                   refPts.shape[0], self.geometric_dimension()))
-        self.netgen_mesh.CalcElementMapping(refPts, curvedPhysPts)
-        cellMap = newFunctionCoordinates.cell_node_map()
-        for i, el in enumerate(self.netgen_mesh.Elements2D()):
-            if el.curved:
-                pts = [tuple(map(lambda x: round(x,8),pts))
-                       for pts in physPts[i][0:refPts.shape[0]]]
-                dofMap = {k: v for v, k in enumerate(pts)}
-                p = [dofMap[tuple(map(lambda x: round(x,8),pts))]
-                     for pts in V[cellMap.values[getIdx(i)]][0:refPts.shape[0]]]
-                curvedPhysPts[i] = curvedPhysPts[i][p]
-                for j, datIdx in enumerate(cellMap.values[getIdx(i)][0:refPts.shape[0]]):
-                    newFunctionCoordinates.sub(0).dat.data[datIdx] = curvedPhysPts[i][j][0]
-                    newFunctionCoordinates.sub(1).dat.data[datIdx] = curvedPhysPts[i][j][1]
-
-    if self.geometric_dimension() == 3:
-        #Mapping to the physical domain
-        physPts = np.ndarray((len(self.netgen_mesh.Elements3D()),
-                             refPts.shape[0], self.geometric_dimension()))
-        self.netgen_mesh.CalcElementMapping(refPts, physPts)
-        #Cruving the mesh
-        self.netgen_mesh.Curve(order)
-        curvedPhysPts = np.ndarray((len(self.netgen_mesh.Elements3D()),
-                                   refPts.shape[0], self.geometric_dimension()))
-        self.netgen_mesh.CalcElementMapping(refPts, curvedPhysPts)
-        cellMap = newFunctionCoordinates.cell_node_map()
-        for i, el in enumerate(self.netgen_mesh.Elements3D()):
-            if el.curved:
-                pts = [tuple(map(lambda x: round(x,8),pts))
-                       for pts in physPts[i][0:refPts.shape[0]]]
-                dofMap = {k: v for v, k in enumerate(pts)}
-                p = [dofMap[tuple(map(lambda x: round(x,8),pts))]
-                     for pts in V[cellMap.values[getIdx(i)]][0:refPts.shape[0]]]
-                curvedPhysPts[i] = curvedPhysPts[i][p]
-                for j, datIdx in enumerate(cellMap.values[getIdx(i)][0:refPts.shape[0]]):
-                    newFunctionCoordinates.sub(0).dat.data[datIdx] = curvedPhysPts[i][j][0]
-                    newFunctionCoordinates.sub(1).dat.data[datIdx] = curvedPhysPts[i][j][1]
-                    newFunctionCoordinates.sub(2).dat.data[datIdx] = curvedPhysPts[i][j][2]
+    refPts = _referencePoints(ref_element, d, order)
+    nR = refPts.shape[0]
+    cellMap = newFunctionCoordinates.cell_node_map()
+    if d == 2:
+        els = self.netgen_mesh.Elements2D()
+    elif d == 3:
+        els = self.netgen_mesh.Elements3D()
+    else:
+        return newFunctionCoordinates
+    nE = len(els)
+    #Mapping to the physical domain
+    physPts = np.empty((nE, nR, d), dtype=np.float64)
+    self.netgen_mesh.CalcElementMapping(refPts, physPts)
+    #Cruving the mesh
+    self.netgen_mesh.Curve(order)
+    curved = np.nonzero(np.fromiter((el.curved for el in els), dtype=bool, count=nE))[0]
+    if curved.size == 0:
+        #Nothing has been curved, the straight coordinates are already correct
+        return newFunctionCoordinates
+    #The straight points are only needed on curved cells, hence we copy them out
+    #and reuse the same buffer for the curved points
+    physPts, curvedPhysPts = physPts[curved], physPts
+    self.netgen_mesh.CalcElementMapping(refPts, curvedPhysPts)
+    cellDofs = cellMap.values[_cellOffsets(self, nE)[curved]][:, 0:nR]
+    data = newFunctionCoordinates.dat.data
+    #Matching the Netgen points with the Firedrake dofs
+    p = _cachedCellPermutation(physPts, data[cellDofs], d, order, keyPrecision)
+    curvedPhysPts = np.take_along_axis(curvedPhysPts[curved], p[:, :, None], axis=1)
+    data[cellDofs.ravel()] = curvedPhysPts.reshape(-1, d)
     return newFunctionCoordinates
 
+if fd is not None:
+    #Patching the Firedrake mesh class once, when this module is imported
+    setattr(fd.MeshGeometry, "refine_marked_elements", refineMarkedElements)
+    setattr(fd.MeshGeometry, "curve_field", curveField)
+
 class FiredrakeMesh:
     '''
     This class creates a Firedrake mesh from Netgen/NGSolve meshes.
@@ -184,5 +364,3 @@ class FiredrakeMesh:
         else:
             self.firedrakeMesh.sfBCInv = None
         self.firedrakeMesh.comm = self.comm
-        setattr(fd.MeshGeometry, "refine_marked_elements", refineMarkedElements)
-        setattr(fd.MeshGeometry, "curve_field", curveField)
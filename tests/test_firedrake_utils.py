@@ -0,0 +1,120 @@
+'''
+This module test the point matching used to curve Firedrake meshes
+'''
+import itertools
+import math
+import numpy as np
+import pytest
+
+from ngsPETSc.utils.firedrake import _cellPermutation, _cachedCellPermutation, _permCache
+
+def referencePoints(d, order):
+    '''
+    Lagrange points of the given order on the vertices, edges and faces
+    of the reference simplex, vertices first, as mapped by Netgen
+    '''
+    verts = np.vstack([np.zeros(d), np.eye(d)])
+    pts = list(verts)
+    for dim in range(1, d):
+        for entity in itertools.combinations(range(d+1), dim+1):
+            for m in itertools.product(range(1, order), repeat=dim+1):
+                if sum(m) == order:
+                    pts.append(sum(mi*verts[e] for mi, e in zip(m, entity))/order)
+    return np.array(pts)
+
+def randomCells(d, order, nC, seed=0):
+    '''
+    Points computed by Netgen and points associated with the Firedrake dofs
+    for random cells, whose vertices are ordered differently by Netgen and Firedrake
+    '''
+    rng = np.random.default_rng(seed)
+    refPts = referencePoints(d, order)
+    baryFiredrake = np.c_[1-refPts.sum(axis=1), refPts]
+    #Netgen uses a different convention for the barycentric coordinates
+    baryNetgen = np.roll(baryFiredrake, -1, axis=1)
+    vertices = rng.random((nC, d+1, d))
+    vertexPerm = np.array([rng.permutation(d+1) for _ in range(nC)])
+    physPts = np.einsum("im,cmk->cik", baryNetgen, vertices)
+    dofPts = np.einsum("im,cmk->cik", baryFiredrake,
+                       np.take_along_axis(vertices, vertexPerm[:, :, None], axis=1))
+    return physPts, dofPts
+
+def checkPermutation(physPts, dofPts, p):
+    '''
+    Checking that the permutation maps the Netgen points to the Firedrake dofs
+    '''
+    assert np.allclose(np.take_along_axis(physPts, p[:, :, None], axis=1), dofPts,
+                       rtol=0, atol=1e-8)
+
+@pytest.mark.parametrize("d", [2, 3])
+@pytest.mark.parametrize("order", [1, 2, 3, 4])
+def test_cached_permutation(d, order):
+    '''
+    Testing the cached permutation against the full point matching
+    for random vertex orderings
+    '''
+    physPts, dofPts = randomCells(d, order, 200)
+    p = _cachedCellPermutation(physPts, dofPts, d, order)
+    checkPermutation(physPts, dofPts, p)
+    assert np.array_equal(p, _cellPermutation(physPts, dofPts))
+
+@pytest.mark.parametrize("d", [2, 3])
+def test_cached_permutation_cache(d):
+    '''
+    Testing that the cache holds one permutation per vertex ordering
+    '''
+    _permCache.clear()
+    physPts, dofPts = randomCells(d, 3, 500)
+    _cachedCellPermutation(physPts, dofPts, d, 3)
+    assert len(_permCache) == math.factorial(d+1)
+    #A second call is served by the cache
+    physPts, dofPts = randomCells(d, 3, 500, seed=1)
+    checkPermutation(physPts, dofPts, _cachedCellPermutation(physPts, dofPts, d, 3))
+    assert len(_permCache) == math.factorial(d+1)
+
+@pytest.mark.parametrize("d", [2, 3])
+def test_cached_permutation_fallback(d):
+    '''
+    Testing that the full point matching is used when the points of a cell
+    are not a relabelling of its vertices, or the dofs are not vertices first
+    '''
+    rng = np.random.default_rng(2)
+    physPts, dofPts = randomCells(d, 3, 50)
+    dofPts[7] = physPts[7][rng.permutation(physPts.shape[1])]
+    checkPermutation(physPts, dofPts, _cachedCellPermutation(physPts, dofPts, d, 3))
+    dofPts = dofPts[:, ::-1]
+    checkPermutation(physPts, dofPts, _cachedCellPermutation(physPts, dofPts, d, 3))
+
+def test_permutation_hash_collision():
+    '''
+    Testing the point matching when the packed hashes of two points collide,
+    the integer keys (1,0) and (0,1000003) have the same hash
+    '''
+    physPts = np.array([[[1e-8, 0.], [0., 1000003e-8], [0.5, 0.5]]])
+    dofPts = physPts[:, [1, 0, 2]]
+    p = _cellPermutation(physPts, dofPts)
+    assert np.array_equal(p, [[1, 0, 2]])
+
+def test_permutation_mismatch():
+    '''
+    Testing that the point matching fails when the points do not match the dofs
+    '''
+    physPts, dofPts = randomCells(2, 3, 10)
+    dofPts[3, 0] += 1e-3
+    with pytest.raises(ValueError):
+        _cellPermutation(physPts, dofPts)
+
+@pytest.mark.parametrize("order", [1, 2, 3])
+def test_fill_straight_coordinates(order):
+    '''
+    Testing that the affine fill of the straight DG coordinates matches
+    the interpolation of the coordinates of a P1 simplex mesh
+    '''
+    fd = pytest.importorskip("firedrake")
+    from ngsPETSc.utils.firedrake import _fillStraightCoordinates
+    for mesh in (fd.UnitSquareMesh(3, 3), fd.UnitCubeMesh(2, 2, 2)):
+        V = fd.VectorFunctionSpace(mesh, "DG", order)
+        straightCoordinates = fd.Function(V)
+        _fillStraightCoordinates(mesh, straightCoordinates)
+        interpolatedCoordinates = fd.interpolate(mesh.coordinates, V)
+        assert np.allclose(straightCoordinates.dat.data_ro, interpolatedCoordinates.dat.data_ro)